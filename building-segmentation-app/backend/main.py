@@ -2,10 +2,11 @@ from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 import uvicorn
+import asyncio
 import os
 import uuid
+from collections import OrderedDict
 from pathlib import Path
-import aiofiles
 from PIL import Image
 import io
 import base64
@@ -31,6 +32,71 @@ sam2_service = SAM2Service()
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# In-memory LRU of raw upload bytes keyed by file_id, so /generate-masks can
+# decode straight from memory instead of re-reading the file from disk
+UPLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+upload_cache: OrderedDict[str, bytes] = OrderedDict()
+upload_cache_bytes = 0  # running total, maintained by _cache_upload
+
+# file_id -> upload path, so request handlers get O(1) lookups instead of
+# scanning the uploads directory (which grows without bound) per request.
+# Seeded once at startup so ids survive a restart.
+FILE_INDEX: dict[str, Path] = {}
+
+for _path in UPLOAD_DIR.glob("*"):
+    if _path.is_file() and "_colored" not in _path.stem:
+        FILE_INDEX[_path.stem] = _path
+
+
+# Uploads above this size are streamed to disk only, not held in the LRU
+UPLOAD_CACHE_FILE_MAX_BYTES = 32 * 1024 * 1024  # 32 MB
+
+CHUNK_SIZE = 1 << 20  # 1 MB
+
+
+def _save_upload_sync(file_path: Path, fileobj) -> bytes | None:
+    """
+    Stream the upload to disk in chunks with plain sync I/O (run from a
+    worker thread - async file wrappers just add overhead for one sequential
+    write). Returns the full bytes for the LRU when the upload is small
+    enough to cache, else None; memory stays O(chunk) for large files.
+    """
+    chunks = []
+    total = 0
+    with open(file_path, 'wb', buffering=CHUNK_SIZE) as f:
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            total += len(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+                if total > UPLOAD_CACHE_FILE_MAX_BYTES:
+                    chunks = None
+    return b''.join(chunks) if chunks else None
+
+
+def _cache_upload(file_id: str, content: bytes):
+    """Store upload bytes in the LRU, evicting oldest entries past the cap"""
+    global upload_cache_bytes
+    old = upload_cache.pop(file_id, None)
+    if old is not None:
+        upload_cache_bytes -= len(old)
+    upload_cache[file_id] = content
+    upload_cache_bytes += len(content)
+    while upload_cache_bytes > UPLOAD_CACHE_MAX_BYTES:
+        _, evicted = upload_cache.popitem(last=False)
+        upload_cache_bytes -= len(evicted)
+
+
+def _get_cached_upload(file_id: str) -> bytes | None:
+    """Fetch upload bytes from the LRU, refreshing recency on hit"""
+    content = upload_cache.get(file_id)
+    if content is not None:
+        upload_cache.move_to_end(file_id)
+    return content
+
 
 @app.get("/")
 async def root():
@@ -54,10 +120,14 @@ async def upload_image(file: UploadFile = File(...)):
         filename = f"{file_id}{file_extension}"
         file_path = UPLOAD_DIR / filename
 
-        # Save file
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
+        # Stream to disk off the event loop without buffering the whole
+        # upload first; small files also land in the in-memory LRU for
+        # /generate-masks
+        content = await asyncio.to_thread(
+            _save_upload_sync, file_path, file.file)
+        if content is not None:
+            _cache_upload(file_id, content)
+        FILE_INDEX[file_id] = file_path
 
         return {
             "success": True,
@@ -66,6 +136,8 @@ async def upload_image(file: UploadFile = File(...)):
             "message": "Image uploaded successfully"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
@@ -76,18 +148,21 @@ async def generate_masks(file_id: str):
     Generate SAM2 masks for the uploaded image
     """
     try:
-        # Find the uploaded file
-        file_path = None
-        for file in UPLOAD_DIR.iterdir():
-            if file_id in file.name:
-                file_path = file
-                break
+        # Fast path: decode straight from the in-memory upload bytes
+        image_bytes = _get_cached_upload(file_id)
 
-        if not file_path or not file_path.exists():
-            raise HTTPException(status_code=404, detail="Image not found")
+        if image_bytes is None:
+            # Cache miss (e.g. after a restart) - fall back to disk
+            file_path = FILE_INDEX.get(file_id)
+
+            if not file_path or not file_path.exists():
+                raise HTTPException(status_code=404, detail="Image not found")
+
+            image_bytes = await asyncio.to_thread(file_path.read_bytes)
 
         # Generate masks using SAM2
-        masks = await sam2_service.generate_masks(str(file_path))
+        masks = await sam2_service.generate_masks(
+            image_bytes=image_bytes, cache_key=file_id)
 
         return {
             "success": True,
@@ -95,6 +170,12 @@ async def generate_masks(file_id: str):
             "message": "Masks generated successfully"
         }
 
+    except HTTPException:
+        raise
+    except ValueError as e:
+        # Undecodable image bytes (see _load_image_rgb) - client's fault
+        raise HTTPException(
+            status_code=400, detail=f"Mask generation failed: {str(e)}")
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Mask generation failed: {str(e)}")
@@ -107,24 +188,21 @@ async def apply_color(file_id: str, mask_indices: list[int], color: str):
     """
     try:
         # Find the uploaded file
-        file_path = None
-        for file in UPLOAD_DIR.iterdir():
-            if file_id in file.name:
-                file_path = file
-                break
+        file_path = FILE_INDEX.get(file_id)
 
         if not file_path or not file_path.exists():
             raise HTTPException(status_code=404, detail="Image not found")
 
         # Apply color to masks
         colored_image = await sam2_service.apply_color_to_masks(
-            str(file_path), mask_indices, color
+            str(file_path), mask_indices, color, cache_key=file_id
         )
 
-        # Save colored image
-        output_filename = f"{file_id}_colored.png"
+        # Save colored image as WebP - several times smaller than PNG on
+        # photos and cheaper to encode
+        output_filename = f"{file_id}_colored.webp"
         output_path = UPLOAD_DIR / output_filename
-        colored_image.save(output_path)
+        colored_image.save(output_path, format='WEBP', quality=85, method=4)
 
         return {
             "success": True,
@@ -132,6 +210,12 @@ async def apply_color(file_id: str, mask_indices: list[int], color: str):
             "message": "Color applied successfully"
         }
 
+    except HTTPException:
+        raise
+    except ValueError as e:
+        # Undecodable image or malformed hex color - client's fault
+        raise HTTPException(
+            status_code=400, detail=f"Color application failed: {str(e)}")
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Color application failed: {str(e)}")